@@ -12,10 +12,345 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+from pandas.tseries.offsets import QuarterEnd, MonthEnd, YearEnd, Week
 from moonshot import Moonshot
 from moonshot.commission import PerShareCommission
+from moonshot.exceptions import MoonshotParameterError
 from quantrocket.fundamental import get_sharadar_fundamentals_reindexed_like
 
+try:
+    import bottleneck
+except ImportError:
+    bottleneck = None
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+try:
+    from pyarrow import ArrowException
+except ImportError:
+    # without pyarrow, pandas raises ImportError for Parquet I/O
+    ArrowException = ImportError
+
+# Errors that cause the fundamentals disk cache to be bypassed: a missing
+# Parquet engine, an unwritable or unreadable cache directory, or a corrupt
+# cache file
+FUNDAMENTALS_CACHE_ERRORS = (ImportError, OSError, ValueError, ArrowException)
+
+# Fundamentals are only cached on disk for date ranges ending at least this
+# many days ago, as recent dates may still receive newly filed reports
+FUNDAMENTALS_CACHE_MIN_AGE = pd.Timedelta(days=10)
+
+# Fundamentals cached on disk are re-queried once the cache file is this old,
+# so that corrections to historical data are eventually picked up
+FUNDAMENTALS_CACHE_MAX_AGE = pd.Timedelta(days=30)
+
+# Approximate size in bytes of each input array's block of rows when computing
+# F-Scores, so that the few arrays used by each component stay in the CPU cache
+F_SCORE_BLOCK_BYTES = 512 * 1024
+
+# Number of recent fundamentals queries kept in memory, enough for the numeric
+# and REPORTPERIOD queries of one backtest to be reused by the next run over the
+# same dates and sids (e.g. a parameter scan) without keeping older panels alive
+FUNDAMENTALS_MEMORY_CACHE_SIZE = 2
+
+# Recent fundamentals queries, most recent first, as tuples of (index,
+# columns, fields, dimension, fundamentals)
+_fundamentals_cache = []
+
+def _get_fundamentals_reindexed_like(reindex_like, fields, dimension, cache_dir=None):
+    """
+    Return Sharadar fundamentals reindexed like `reindex_like`, reusing the
+    result of a recent identical query (same dates, sids, fields and
+    dimension) if available. The returned DataFrame may be shared and should
+    not be modified in place.
+
+    If `cache_dir` is given, results for date ranges ending at least
+    FUNDAMENTALS_CACHE_MIN_AGE ago are also persisted there as Parquet files,
+    so that they are reused across processes until they are
+    FUNDAMENTALS_CACHE_MAX_AGE old.
+    """
+    fields = list(fields)
+    index = reindex_like.index
+    columns = reindex_like.columns
+
+    for cached_index, cached_columns, cached_fields, cached_dimension, fundamentals in _fundamentals_cache:
+        if (
+            cached_fields == fields
+            and cached_dimension == dimension
+            and cached_index.dtype == index.dtype
+            and cached_index.name == index.name
+            and cached_index.equals(index)
+            and cached_columns.name == columns.name
+            and cached_columns.equals(columns)):
+            return fundamentals
+
+    fundamentals = _query_fundamentals(reindex_like, fields, dimension, cache_dir)
+
+    _fundamentals_cache.insert(0, (index, columns, fields, dimension, fundamentals))
+    del _fundamentals_cache[FUNDAMENTALS_MEMORY_CACHE_SIZE:]
+
+    return fundamentals
+
+def _query_fundamentals(reindex_like, fields, dimension, cache_dir):
+    """
+    Query Sharadar fundamentals reindexed like `reindex_like`, reading from and
+    writing to the Parquet cache in `cache_dir` if given.
+    """
+    index = reindex_like.index
+    filepath = None
+    if cache_dir and len(index):
+        last_date = index[-1]
+        if last_date < pd.Timestamp.now(tz=last_date.tz) - FUNDAMENTALS_CACHE_MIN_AGE:
+            key = hashlib.sha1(repr(
+                (index.name, str(index.dtype), list(reindex_like.columns), fields, dimension)
+            ).encode())
+            key.update(index.asi8.tobytes())
+            filepath = os.path.join(
+                os.path.expanduser(cache_dir), "{0}.parquet".format(key.hexdigest()))
+
+    # The disk cache is best-effort: if it can't be read, fall back to querying
+    if filepath and _is_fresh(filepath):
+        try:
+            cached_fundamentals = pd.read_parquet(filepath)
+            return pd.concat(
+                {field: cached_fundamentals[field] for field in fields},
+                names=["Field", index.name])
+        except FUNDAMENTALS_CACHE_ERRORS + (KeyError,):
+            pass
+
+    fundamentals = get_sharadar_fundamentals_reindexed_like(
+        reindex_like, fields=fields, dimension=dimension)
+
+    if filepath:
+        # Store the fields side by side (dates x fields/sids) so that each
+        # column has a single dtype, as Parquet requires
+        cached_fundamentals = pd.concat(
+            {field: fundamentals.loc[field] for field in fields},
+            axis=1,
+            names=["Field", fundamentals.columns.name]).infer_objects()
+        # write to a temporary file first so that concurrent runs never read a
+        # partially written file. The disk cache is best-effort: if it can't be
+        # written, the query result is still returned
+        tmp_filepath = "{0}.{1}.tmp".format(filepath, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            cached_fundamentals.to_parquet(tmp_filepath, compression="snappy")
+            os.replace(tmp_filepath, filepath)
+        except FUNDAMENTALS_CACHE_ERRORS:
+            try:
+                os.remove(tmp_filepath)
+            except OSError:
+                pass
+
+    return fundamentals
+
+def _is_fresh(filepath):
+    """
+    Return True if `filepath` exists and was written less than
+    FUNDAMENTALS_CACHE_MAX_AGE ago.
+    """
+    try:
+        modified = os.path.getmtime(filepath)
+    except OSError:
+        return False
+    return pd.Timestamp.now().timestamp() - modified < FUNDAMENTALS_CACHE_MAX_AGE.total_seconds()
+
+def _ffill(values, axis=0):
+    """
+    Return a copy of the array `values` with NaNs forward-filled along `axis`.
+
+    Uses bottleneck's push if bottleneck is installed.
+    """
+    if bottleneck is not None:
+        return bottleneck.push(values, axis=axis)
+
+    shape = [1] * values.ndim
+    shape[axis] = -1
+    positions = np.arange(values.shape[axis]).reshape(shape)
+    fill_positions = np.where(np.isnan(values), 0, positions)
+    np.maximum.accumulate(fill_positions, axis=axis, out=fill_positions)
+    return np.take_along_axis(values, fill_positions, axis=axis)
+
+def _get_array_module(values):
+    """
+    Return the array module (numpy or cupy) that `values` belongs to.
+    """
+    if cupy is not None:
+        return cupy.get_array_module(values)
+    return np
+
+def _rolling_mean(values, window):
+    """
+    Return the rolling mean of a 2-D array over `window` rows for all columns
+    at once. As with pandas' default rolling mean, windows containing any NaNs
+    are NaN. The means are accumulated in float64 regardless of the input
+    dtype, and the result has the dtype of `values`.
+
+    Uses bottleneck's moving-window mean if bottleneck is installed, else
+    running sums. Arrays on the GPU (cupy) always use running sums.
+    """
+    xp = _get_array_module(values)
+
+    # bottleneck rejects windows longer than the array
+    if xp is np and bottleneck is not None and window <= len(values):
+        return bottleneck.move_mean(
+            values.astype(np.float64), window, axis=0).astype(values.dtype)
+
+    are_valid = ~xp.isnan(values)
+    running_sums = xp.zeros((values.shape[0] + 1, values.shape[1]))
+    xp.cumsum(xp.where(are_valid, values, 0), axis=0, dtype=np.float64, out=running_sums[1:])
+    running_counts = xp.zeros(running_sums.shape, dtype=np.int64)
+    xp.cumsum(are_valid, axis=0, out=running_counts[1:])
+
+    means = xp.full(values.shape, np.nan, dtype=values.dtype)
+    window_sums = running_sums[window:] - running_sums[:-window]
+    window_counts = running_counts[window:] - running_counts[:-window]
+    means[window-1:] = xp.where(window_counts == window, window_sums / window, np.nan)
+    return means
+
+def _top_pct_mask(values, pct, ascending=True, where=None):
+    """
+    Return a boolean array indicating, for each row of the 2-D array `values`,
+    which values fall in the top `pct` (0-1) of the row, ranking from smallest
+    to largest if `ascending` else from largest to smallest. If `where` is
+    given, only the values where it is True are ranked, as if the others were
+    NaN.
+
+    Equivalent to `df.rank(axis=1, ascending=ascending, pct=True) <= pct`
+    (including the averaging of tied ranks and the exclusion of NaNs), but
+    only touches the eligible values of each row and uses a partial sort to
+    find the cutoff instead of fully ranking them.
+
+    Arrays on the GPU (cupy) are processed with _top_pct_mask_sorted instead,
+    which handles all rows at once rather than looping over them.
+    """
+    if _get_array_module(values) is not np:
+        return _top_pct_mask_sorted(values, pct, ascending=ascending, where=where)
+
+    are_valid = ~np.isnan(values)
+    if where is not None:
+        are_valid &= where
+    valid_counts = are_valid.sum(axis=1)
+
+    mask = np.zeros(values.shape, dtype=bool)
+    for i in np.flatnonzero(valid_counts):
+        count = valid_counts[i]
+
+        # number of positions whose percentile rank is <= pct
+        k = int(pct * count)
+        while k < count and (k + 1) / count <= pct:
+            k += 1
+        while k > 0 and k / count > pct:
+            k -= 1
+        if k == 0:
+            continue
+
+        columns = np.flatnonzero(are_valid[i])
+        row = values[i, columns]
+        if not ascending:
+            row = -row
+
+        # values better than the k-th value are always selected; values tied
+        # with it are selected only if their average rank qualifies
+        cutoff = np.partition(row, k - 1)[k - 1]
+        are_selected = row < cutoff
+        are_tied = row == cutoff
+        if (are_selected.sum() + (are_tied.sum() + 1) / 2) / count <= pct:
+            are_selected |= are_tied
+        mask[i, columns[are_selected]] = True
+
+    return mask
+
+def _top_pct_mask_sorted(values, pct, ascending=True, where=None):
+    """
+    Equivalent of _top_pct_mask which sorts all rows at once instead of
+    partitioning them one at a time. This suits the GPU, where per-row
+    loops would launch many small kernels.
+    """
+    xp = _get_array_module(values)
+
+    are_valid = ~xp.isnan(values)
+    if where is not None:
+        are_valid &= where
+    valid_counts = are_valid.sum(axis=1)
+
+    values = values.astype(np.float64)
+    if not ascending:
+        values = -values
+    values = xp.where(are_valid, values, np.inf)
+
+    # number of positions per row whose percentile rank is <= pct
+    with np.errstate(divide="ignore", invalid="ignore"):
+        k = (pct * valid_counts).astype(np.int64)
+        k += (k < valid_counts) & ((k + 1) / valid_counts <= pct)
+        k -= (k > 0) & (k / valid_counts > pct)
+
+    # values better than the k-th value of each row are always selected; values
+    # tied with it are selected only if their average rank qualifies
+    cutoffs = xp.take_along_axis(
+        xp.sort(values, axis=1), xp.maximum(k - 1, 0)[:, np.newaxis], axis=1)
+    are_selected = (values < cutoffs) & are_valid
+    are_tied = (values == cutoffs) & are_valid
+    with np.errstate(divide="ignore", invalid="ignore"):
+        are_ties_selected = (
+            are_selected.sum(axis=1) + (are_tied.sum(axis=1) + 1) / 2) / valid_counts <= pct
+    are_selected |= are_tied & are_ties_selected[:, np.newaxis]
+    are_selected &= (k > 0)[:, np.newaxis]
+
+    return are_selected
+
+def _add_f_score_components(f_scores, indicators, previous_indicators,
+                            shares_out, previous_shares_out,
+                            total_assets, operating_cash_flows):
+    """
+    Add the nine Piotroski F-Score components (each 0 or 1) to the int8 array
+    `f_scores` in place. `indicators` and `previous_indicators` are stacked
+    (ROA, DE, CURRENTRATIO, GROSSMARGIN, ASSETTURNOVER) blocks of current and
+    previous fiscal period values, and `shares_out` and `previous_shares_out`
+    the corresponding SHARESWA values. Comparisons involving NaNs evaluate to
+    False, as they do in pandas.
+    """
+    (return_on_assets, leverages, current_ratios, gross_margins,
+     asset_turnovers) = indicators
+    (previous_return_on_assets, previous_leverages, previous_current_ratios,
+     previous_gross_margins, previous_asset_turnovers) = previous_indicators
+
+    component = np.empty(f_scores.shape, dtype=bool)
+
+    def add_component(compare, left, right):
+        compare(left, right, out=component)
+        np.add(f_scores, component, out=f_scores)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cash_flows_to_assets = operating_cash_flows / total_assets
+
+    # positive return on assets
+    add_component(np.greater, return_on_assets, 0)
+    # positive operating cash flow
+    add_component(np.greater, operating_cash_flows, 0)
+    # increasing return on assets
+    add_component(np.greater, return_on_assets, previous_return_on_assets)
+    # more cash flow than income
+    add_component(np.greater, cash_flows_to_assets, return_on_assets)
+    # decreasing leverage
+    add_component(np.less, leverages, previous_leverages)
+    # increasing current ratio
+    add_component(np.greater, current_ratios, previous_current_ratios)
+    # no new shares
+    add_component(np.less_equal, shares_out, previous_shares_out)
+    # increasing gross margin
+    add_component(np.greater, gross_margins, previous_gross_margins)
+    # increasing asset turnover
+    add_component(np.greater, asset_turnovers, previous_asset_turnovers)
+
 class USStockCommission(PerShareCommission):
     BROKER_COMMISSION_PER_SHARE = 0.005
 
@@ -51,141 +386,250 @@ class QuantitativeValue(Moonshot):
     QUALITY_TOP_N_PCT = 50
     REBALANCE_INTERVAL = "Q"
     COMMISSION_CLASS = USStockCommission
+    F_SCORE_FIELDS = [
+        "ROA", # Return on assets
+        "ASSETS", # Total Assets
+        "NCFO", # Net Cash Flow from Operations
+        "DE", # Debt to Equity Ratio
+        "CURRENTRATIO", # Current ratio
+        "SHARESWA", # Outstanding shares
+        "GROSSMARGIN", # Gross margin
+        "ASSETTURNOVER", # Asset turnover
+    ]
+    # run the dollar volume, value and quality screens on the GPU (requires cupy)
+    USE_GPU = False
+    # Optional directory (e.g. "~/.cache/qval") for caching fundamentals on
+    # disk as Parquet files, so that backtests ending at least
+    # FUNDAMENTALS_CACHE_MIN_AGE ago can reuse them across processes. Disabled
+    # (None) by default. Each distinct date range and set of sids is stored in
+    # its own file, and files older than FUNDAMENTALS_CACHE_MAX_AGE are
+    # re-queried to pick up vendor corrections; to clear the cache, delete the
+    # directory
+    FUNDAMENTALS_CACHE_DIR = None
 
     def prices_to_signals(self, prices):
 
-        # Step 1.c: get a mask of stocks with adequate dollar volume
+        # Step 1.c: get a mask of stocks with adequate dollar volume. All of the
+        # screens below work on the underlying arrays, which share the dates and
+        # sids of closes; labels are reattached once, to the final signals.
+        # Prices and fundamentals (except share counts, see get_f_scores) are
+        # downcast to float32, which halves the memory the screens move. If
+        # USE_GPU is True, the arrays are moved to the GPU for the screens
+        if self.USE_GPU:
+            if cupy is None:
+                raise MoonshotParameterError("USE_GPU = True requires cupy to be installed")
+            xp = cupy
+        else:
+            xp = np
+
         closes = prices.loc["Close"]
         volumes = prices.loc["Volume"]
-        avg_dollar_volumes = (closes * volumes).rolling(self.DOLLAR_VOLUME_WINDOW).mean()
-        dollar_volume_ranks = avg_dollar_volumes.rank(axis=1, ascending=False, pct=True)
-        have_adequate_dollar_volumes = dollar_volume_ranks <= (self.DOLLAR_VOLUME_TOP_N_PCT/100)
+        dollar_volumes = xp.multiply(
+            xp.asarray(closes.to_numpy(dtype=np.float32)),
+            xp.asarray(volumes.to_numpy(dtype=np.float32)))
+        avg_dollar_volumes = _rolling_mean(dollar_volumes, self.DOLLAR_VOLUME_WINDOW)
+        have_adequate_dollar_volumes = _top_pct_mask(
+            avg_dollar_volumes, self.DOLLAR_VOLUME_TOP_N_PCT/100, ascending=False)
 
         # Step 2. Apply value screen: select cheapest N percent of stocks by
         # enterprise multiple (EV/EBITDA) (N=10)
-        fundamentals = get_sharadar_fundamentals_reindexed_like(
+        # Query the numeric value and quality indicators in a single request.
+        # REPORTPERIOD (used to identify new fiscal periods for the F-Score) is
+        # queried separately, as mixing its dates into the numeric fields would
+        # make the whole frame object dtype
+        fundamentals = _get_fundamentals_reindexed_like(
+            closes,
+            fields=["EVEBIT", "EBIT"] + self.F_SCORE_FIELDS,
+            dimension="ART",
+            cache_dir=self.FUNDAMENTALS_CACHE_DIR)
+        fiscal_periods = _get_fundamentals_reindexed_like(
             closes,
-            fields=["EVEBIT", "EBIT"],
-            dimension="ART")
-        enterprise_multiples = fundamentals.loc["EVEBIT"]
-        ebits = fundamentals.loc["EBIT"]
-        # Ignore negative earnings
-        enterprise_multiples = enterprise_multiples.where(ebits > 0)
-        # Only apply rankings to stocks with adequate dollar volume
-        value_ranks = enterprise_multiples.where(have_adequate_dollar_volumes).rank(axis=1, ascending=True, pct=True)
-        are_value_stocks = value_ranks <= (self.VALUE_TOP_N_PCT/100)
+            fields=["REPORTPERIOD"],
+            dimension="ART",
+            cache_dir=self.FUNDAMENTALS_CACHE_DIR).loc["REPORTPERIOD"]
+        enterprise_multiples = xp.asarray(fundamentals.loc["EVEBIT"].to_numpy(dtype=np.float32))
+        ebits = xp.asarray(fundamentals.loc["EBIT"].to_numpy(dtype=np.float32))
+        # Ignore negative earnings, and only apply rankings to stocks with
+        # adequate dollar volume
+        are_value_stocks = _top_pct_mask(
+            enterprise_multiples,
+            self.VALUE_TOP_N_PCT/100,
+            ascending=True,
+            where=(ebits > 0) & have_adequate_dollar_volumes)
 
         # Step 3: Rank by quality: of the value stocks, select the N percent
         # with the highest quality, as ranked by Piotroski F-Score (N=50)
-        f_scores = self.get_f_scores(closes)
+        f_scores = self.get_f_scores(
+            closes, fundamentals=fundamentals, fiscal_periods=fiscal_periods)
         # Rank the value stocks by F-Score
-        quality_ranks = f_scores.where(are_value_stocks).rank(axis=1, ascending=False, pct=True)
-        long_signals = quality_ranks <= (self.QUALITY_TOP_N_PCT/100)
+        long_signals = _top_pct_mask(
+            xp.asarray(f_scores.to_numpy()),
+            self.QUALITY_TOP_N_PCT/100,
+            ascending=False,
+            where=are_value_stocks)
+        if xp is not np:
+            long_signals = xp.asnumpy(long_signals)
 
-        return long_signals.astype(int)
+        return pd.DataFrame(long_signals.astype(np.int8), index=closes.index, columns=closes.columns)
 
-    def get_f_scores(self, closes):
+    def get_f_scores(self, closes, fundamentals=None, fiscal_periods=None):
+        """
+        Return a DataFrame of Piotroski F-Scores (0-9) shaped like `closes`.
 
+        `fundamentals` may be a DataFrame of Sharadar fundamentals reindexed
+        like `closes` which includes F_SCORE_FIELDS, and `fiscal_periods` a
+        DataFrame of REPORTPERIOD dates reindexed like `closes`; if omitted,
+        they are queried.
+        """
         # Step 1: query relevant indicators
-        fundamentals = get_sharadar_fundamentals_reindexed_like(
-            closes,
-           dimension="ART", # As-reported trailing twelve month reports
-           fields=[
-               "ROA", # Return on assets
-               "ASSETS", # Total Assets
-               "NCFO", # Net Cash Flow from Operations
-               "DE", # Debt to Equity Ratio
-               "CURRENTRATIO", # Current ratio
-               "SHARESWA", # Outstanding shares
-               "GROSSMARGIN", # Gross margin
-               "ASSETTURNOVER", # Asset turnover
-           ])
-        return_on_assets = fundamentals.loc["ROA"]
-        total_assets = fundamentals.loc["ASSETS"]
-        operating_cash_flows = fundamentals.loc["NCFO"]
-        leverages = fundamentals.loc["DE"]
-        current_ratios = fundamentals.loc["CURRENTRATIO"]
-        shares_out = fundamentals.loc["SHARESWA"]
-        gross_margins = fundamentals.loc["GROSSMARGIN"]
-        asset_turnovers = fundamentals.loc["ASSETTURNOVER"]
+        if fundamentals is None:
+            fundamentals = _get_fundamentals_reindexed_like(
+                closes,
+                fields=self.F_SCORE_FIELDS,
+                dimension="ART", # As-reported trailing twelve month reports
+                cache_dir=self.FUNDAMENTALS_CACHE_DIR)
+
+        # Cast the indicators to float32. The five ratios that are compared to
+        # their previous values are stacked into one (indicator x date x sid)
+        # block. Share counts stay float64: float32 only represents integers
+        # exactly up to 2**24, so small share issuances would be rounded away
+        indicators = np.stack([
+            fundamentals.loc[field].to_numpy(dtype=np.float32)
+            for field in ("ROA", "DE", "CURRENTRATIO", "GROSSMARGIN", "ASSETTURNOVER")
+        ])
+        shares_out = fundamentals.loc["SHARESWA"].to_numpy(dtype=np.float64)
+        total_assets = fundamentals.loc["ASSETS"].to_numpy(dtype=np.float32)
+        operating_cash_flows = fundamentals.loc["NCFO"].to_numpy(dtype=np.float32)
 
         # Step 2: many Piotroski F-score components compare current to previous
-        # values, so get DataFrames of previous values
+        # values, so get arrays of previous values
 
         # Step 2.a: get a boolean mask of the first day of each newly reported fiscal
         # period
-        fundamentals = get_sharadar_fundamentals_reindexed_like(
-            closes,
-            dimension="ART", # As-reported trailing twelve month reports
-            fields=["REPORTPERIOD"])
-        fiscal_periods = fundamentals.loc["REPORTPERIOD"]
-        are_new_fiscal_periods = fiscal_periods != fiscal_periods.shift()
-
-        # Step 2.b: shift the ROAs forward one fiscal period by (1) shifting the ratios one day,
-        # (2) keeping only the ones that fall on the first day of the newly reported
-        # fiscal period, and (3) forward-filling
-        previous_return_on_assets = return_on_assets.shift().where(are_new_fiscal_periods).fillna(method="ffill")
-
-        # Step 2.c: Repeat for other indicators
-        previous_leverages = leverages.shift().where(are_new_fiscal_periods).fillna(method="ffill")
-        previous_current_ratios = current_ratios.shift().where(are_new_fiscal_periods).fillna(method="ffill")
-        previous_shares_out = shares_out.shift().where(are_new_fiscal_periods).fillna(method="ffill")
-        previous_gross_margins = gross_margins.shift().where(are_new_fiscal_periods).fillna(method="ffill")
-        previous_asset_turnovers = asset_turnovers.shift().where(are_new_fiscal_periods).fillna(method="ffill")
-
-        # Step 3: calculate F-Score components; each resulting component is a DataFrame
-        # of booleans
-        have_positive_return_on_assets = return_on_assets > 0
-        have_positive_operating_cash_flows = operating_cash_flows > 0
-        have_increasing_return_on_assets = return_on_assets > previous_return_on_assets
-        have_more_cash_flow_than_incomes = operating_cash_flows / total_assets > return_on_assets
-        have_decreasing_leverages = leverages < previous_leverages
-        have_increasing_current_ratios = current_ratios > previous_current_ratios
-        have_no_new_shares = shares_out <= previous_shares_out
-        have_increasing_gross_margins = gross_margins > previous_gross_margins
-        have_increasing_asset_turnovers = asset_turnovers > previous_asset_turnovers
-
-        # Step 4: convert the booleans to integers and sum to get F-Score (0-9)
-        f_scores = (
-            have_positive_return_on_assets.astype(int)
-            + have_positive_operating_cash_flows.astype(int)
-            + have_increasing_return_on_assets.astype(int)
-            + have_more_cash_flow_than_incomes.astype(int)
-            + have_decreasing_leverages.astype(int)
-            + have_increasing_current_ratios.astype(int)
-            + have_no_new_shares.astype(int)
-            + have_increasing_gross_margins.astype(int)
-            + have_increasing_asset_turnovers.astype(int)
-        )
+        if fiscal_periods is None:
+            fiscal_periods = _get_fundamentals_reindexed_like(
+                closes,
+                fields=["REPORTPERIOD"],
+                dimension="ART",
+                cache_dir=self.FUNDAMENTALS_CACHE_DIR).loc["REPORTPERIOD"]
+        # Compare consecutive periods on the underlying datetime64 (int64) values
+        # (the conversion is a no-op for the datetime64 frame the query returns).
+        # Missing periods (NaT) never compare equal, so they always count as new
+        fiscal_periods = pd.to_datetime(
+            fiscal_periods.to_numpy().ravel()).to_numpy().reshape(fiscal_periods.shape)
+        are_new_fiscal_periods = np.empty(fiscal_periods.shape, dtype=bool)
+        are_new_fiscal_periods[:1] = True
+        np.not_equal(fiscal_periods[1:], fiscal_periods[:-1], out=are_new_fiscal_periods[1:])
+
+        # Step 2.b: get the value of each indicator on the day before the current
+        # fiscal period began, i.e. the last value of the previous period. Report
+        # dates differ by company, so the first row of the current fiscal period
+        # is located for each date and sid (once, for all indicators), and the
+        # previous values are gathered from the stacked block in a single lookup
+        # (and from the share counts in another). Where the previous period's
+        # value is missing, forward-filling carries over the value from the most
+        # recent earlier period that has one
+        rows = np.arange(len(closes.index))[:, np.newaxis]
+        period_start_rows = np.maximum.accumulate(
+            np.where(are_new_fiscal_periods, rows, 0), axis=0)
+        previous_rows = np.maximum(period_start_rows - 1, 0)
+        # the first fiscal period has no previous period
+        are_first_fiscal_periods = period_start_rows == 0
+        previous_indicators = np.take_along_axis(indicators, previous_rows[np.newaxis], axis=1)
+        previous_indicators[:, are_first_fiscal_periods] = np.nan
+        previous_indicators = _ffill(previous_indicators, axis=1)
+        previous_shares_out = np.take_along_axis(shares_out, previous_rows, axis=0)
+        previous_shares_out[are_first_fiscal_periods] = np.nan
+        previous_shares_out = _ffill(previous_shares_out)
+
+        # Step 3: calculate the F-Score components and sum them to get F-Score (0-9).
+        # The components are accumulated directly into an int8 array. Rows are
+        # processed in blocks small enough for a block's inputs to stay in the
+        # CPU cache while all nine components are computed, so that each input is
+        # read from main memory once rather than once per component
+        scores = np.zeros(closes.shape, dtype=np.int8)
+        block_size = max(1, F_SCORE_BLOCK_BYTES // max(1, closes.shape[1] * indicators.itemsize))
+        for start in range(0, len(scores), block_size):
+            block = slice(start, start + block_size)
+            _add_f_score_components(
+                scores[block],
+                indicators[:, block],
+                previous_indicators[:, block],
+                shares_out[block],
+                previous_shares_out[block],
+                total_assets[block],
+                operating_cash_flows[block])
+
+        f_scores = pd.DataFrame(scores, index=closes.index, columns=closes.columns)
 
         self.save_to_results("FScore", f_scores)
         return f_scores
 
     def signals_to_target_weights(self, signals, prices):
-        # Step 4: equal weights
-        daily_signal_counts = signals.abs().sum(axis=1)
-        weights = signals.div(daily_signal_counts, axis=0).fillna(0)
+        # Step 4: equal weights. Each day's signals are multiplied by the inverse
+        # of the day's signal count; days without signals get an inverse of 0, so
+        # they have zero weights without generating NaNs to fill afterward
+        weights = signals.to_numpy(dtype=float, copy=True)
+        daily_signal_counts = np.abs(weights).sum(axis=1)
+        inverse_signal_counts = np.zeros(daily_signal_counts.shape)
+        np.divide(1, daily_signal_counts, out=inverse_signal_counts, where=daily_signal_counts > 0)
+        weights *= inverse_signal_counts[:, np.newaxis]
 
         # Step 5: Rebalance quarterly
-        # Resample daily to quarterly, taking the last day's signal
+        # Each day takes the last day's signal of the most recently completed
+        # quarter. For single calendar periods (Q, M, A, and weeks anchored to a
+        # weekday, e.g. W), the source row for every day is looked up in a single
+        # pass: a period is complete on its final calendar day, so a day belongs
+        # to the period before the one containing the following calendar day.
+        # As with resampling, if the completed period has no rows, the day has
+        # no weights. Other offsets (e.g. "BM", "QS", "2Q", unanchored weeks)
+        # resample daily to the interval, taking the last day's signal, then
+        # reindex back to daily and fill forward.
         # For pandas offset aliases, see https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases
-        weights = weights.resample(self.REBALANCE_INTERVAL).last()
-        # Reindex back to daily and fill forward
-        weights = weights.reindex(prices.loc["Close"].index, method="ffill")
+        dates = signals.index
+        rebalance_interval = to_offset(self.REBALANCE_INTERVAL)
+        if rebalance_interval.n == 1 and (
+                type(rebalance_interval) in (QuarterEnd, MonthEnd, YearEnd)
+                or (type(rebalance_interval) is Week and rebalance_interval.weekday is not None)):
+            periods = dates.to_period(rebalance_interval).asi8
+            completed_periods = (dates + pd.Timedelta(days=1)).to_period(rebalance_interval).asi8 - 1
+            rebalance_rows = np.searchsorted(periods, completed_periods, side="right") - 1
+            rebalanced_weights = weights[rebalance_rows]
+            # Days whose completed period has no rows, including days before the
+            # first period (where the lookup wraps around to a later period),
+            # have no weights
+            rebalanced_weights[periods[rebalance_rows] != completed_periods] = np.nan
+            weights = pd.DataFrame(rebalanced_weights, index=dates, columns=signals.columns)
+        else:
+            weights = pd.DataFrame(weights, index=dates, columns=signals.columns)
+            weights = weights.resample(self.REBALANCE_INTERVAL).last()
+            weights = weights.reindex(dates, method="ffill")
 
         return weights
 
     def target_weights_to_positions(self, weights, prices):
         # Enter the position the day after the signal
-        return weights.shift()
+        return weights.shift(fill_value=0)
 
     def positions_to_gross_returns(self, positions, prices):
 
         closes = prices.loc["Close"]
-        position_ends = positions.shift()
 
         # The return is the security's percent change over the period,
-        # multiplied by the position.
-        gross_returns = closes.pct_change() * position_ends
+        # multiplied by the position. The position is collected at the end of
+        # the period, i.e. the prior day's position is applied to each day's
+        # percent change. As with pct_change, missing prices are filled forward
+        # before computing the change. Both steps are computed in place in a
+        # single output array.
+        closes = closes.ffill().to_numpy(dtype=float)
+        # positions shifted forward one day, aligned with gross_returns[1:]
+        position_ends = positions.to_numpy(dtype=float)[:-1]
+
+        gross_returns = np.empty(closes.shape)
+        gross_returns[:1] = np.nan
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(closes[1:], closes[:-1], out=gross_returns[1:])
+        gross_returns[1:] -= 1
+        gross_returns[1:] *= position_ends
 
-        return gross_returns
+        return pd.DataFrame(gross_returns, index=positions.index, columns=positions.columns)